@@ -1,173 +1,243 @@
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+import numpy as np
+import re
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 localpath = lambda path: Path(__file__).parent / path
-
-DATA = defaultdict(lambda: defaultdict(dict))
-
-def read_tables(glob_filter):
-    global DATA
-    for file in localpath(".").glob(glob_filter):
-        device = file.name[5:-4]
+CACHE_FILE = localpath(".cache.npz")
+# Bump when parse_table, convert, SCALE or the Series fields change
+CACHE_VERSION = 1
+
+Series = namedtuple("Series", "inp meas cyc")
+SCALE = {"ns": 1e9, "us": 1e6}
+HEADER_RE = re.compile(rb"modm::delay_(\w\w) for system clock = (\d+)")
+# Column separators and the out-of-range markers become whitespace
+ROW_TRANS = bytes.maketrans(b"|<>", b"   ")
+
+device_name = lambda file: file.name[5:-4]
+
+def read_tables(glob_filter, data):
+    cache, cache_mtime = load_cache()
+    files = list(localpath(".").glob(glob_filter))
+    stale = [file for file in files
+             if device_name(file) not in cache or file.stat().st_mtime >= cache_mtime]
+    parsed = dict(map(parse_file, stale))
+    for file in files:
+        device = device_name(file)
         print(device)
-        tables = file.read_text().split("\n\n")
-        for table in tables:
-            data = parse_table(table)
-            DATA[device][data[0]][data[1]] = data[2]
-
-def parse_table(text):
-    lines = text.strip().splitlines()
-    clock = int(lines[0].split(" = ")[1])
-    dtype = lines[0][12:14]
-    def conv(delay, cycles):
-        return (cycles * (1e9 if dtype == "ns" else 1e6)) / clock;
-    data = []
-    for line in lines[3:]:
-        values = [int(v.strip()) for v in line.rstrip("><").split(" | ")]
-        data.append( (values[0], conv(values[0], values[2]), values[2]) )
+        data.update(parsed[device] if device in parsed else cache[device])
+    if parsed:
+        save_cache(data)
+
+def parse_file(file):
+    device = device_name(file)
+    tables = {(device, dtype, clock): series for dtype, clock, series in read_file(file)}
+    return (device, tables)
+
+def read_file(file):
+    # Streams the raw bytes, so only the rows of the current table are kept around
+    with file.open("rb") as f:
+        rows = None
+        for line in f:
+            header = HEADER_RE.match(line)
+            if header:
+                dtype, clock = header.group(1).decode(), int(header.group(2))
+                # skip the two column title lines
+                next(f); next(f)
+                rows = []
+            elif line.strip():
+                rows.append(line)
+            elif rows:
+                yield parse_table(dtype, clock, rows)
+                rows = None
+        if rows:
+            yield parse_table(dtype, clock, rows)
+
+def load_cache():
+    # Cached tables grouped by device, so each file can be served on its own
+    cache = defaultdict(dict)
+    if not CACHE_FILE.exists():
+        return (cache, 0)
+    columns = defaultdict(dict)
+    try:
+        with np.load(CACHE_FILE) as npz:
+            if "version" not in npz.files or npz["version"] != CACHE_VERSION:
+                return (defaultdict(dict), 0)
+            for key in npz.files:
+                if key == "version": continue
+                device, dtype, clock, column = key.split("|")
+                columns[(device, dtype, int(clock))][column] = npz[key]
+        for key, series in columns.items():
+            cache[key[0]][key] = Series(**series)
+    except Exception:
+        # A truncated or otherwise unreadable cache is simply re-parsed
+        return (defaultdict(dict), 0)
+    return (cache, CACHE_FILE.stat().st_mtime)
+
+def save_cache(data):
+    arrays = {"version": np.array(CACHE_VERSION)}
+    for (device, dtype, clock), series in data.items():
+        for column, values in series._asdict().items():
+            arrays["{}|{}|{}|{}".format(device, dtype, clock, column)] = values
+    np.savez(CACHE_FILE, **arrays)
+
+def convert(cycles, clock, scale):
+    # Scale measured cycles to ns or us into one float64 array, no temporaries
+    out = np.multiply(cycles, scale, dtype=np.float64)
+    out /= clock
+    return out
+
+def parse_table(dtype, clock, rows):
+    # Parse all rows in one C call instead of building a list per row
+    text = b"".join(rows).translate(ROW_TRANS)
+    values = np.fromstring(text, dtype=np.int64, sep=" ").reshape(-1, 4)
+    converted = convert(values[:, 2], clock, SCALE[dtype])
+    data = Series(np.asarray(values[:, 0], np.int32), converted,
+                  np.asarray(values[:, 2], np.int32))
 
     return (dtype, clock, data)
 
 
-def plot_table(filter_):
-    global DATA
-    for device, dtypes in DATA.items():
-        for dtype, clocks in dtypes.items():
-            for clock, delays in clocks.items():
-                # print(device, dtype, clock)
-                filtered = [d for d in delays if filter_(device, dtype, clock, d)]
-                if filtered:
-                    plt.plot([v[0] for v in filtered], [v[1] for v in filtered])
-
-def dump_summary():
-    global DATA
-    for device, dtypes in DATA.items():
-        minmax_clock = (1e9, 0)
-        min_cycles_boot = 1e9
-        min_cycles_high = 1e9
-        for dtype, clocks in dtypes.items():
-            for clock, delays in clocks.items():
-                minmax_clock = (min(minmax_clock[0], clock), max(minmax_clock[1], clock))
-                min_cycles = min(d[2] for d in delays)
-                if clock <= 16e6:
-                    min_cycles_boot = min(min_cycles_boot, min_cycles)
-                else:
-                    min_cycles_high = min(min_cycles_high, min_cycles)
+def clock_bucket(device, clock):
+    # The STM32H7 boots at 64MHz, everything else at or below 16MHz
+    boot_clock = 64e6 if device.startswith("h7") else 16e6
+    return "boot" if clock <= boot_clock else "high"
+
+def index_tables(data):
+    index = defaultdict(list)
+    for (device, dtype, clock), series in data.items():
+        index[(dtype, clock_bucket(device, clock))].append((device, clock, series))
+    return index
+
+def plot_table(ax, index, key, max_input, exclude=None):
+    segments = []
+    for device, clock, series in index[key]:
+        # print(device, key, clock)
+        if exclude is not None and exclude in device: continue
+        mask = series.inp <= max_input
+        if mask.any():
+            segments.append(np.column_stack([series.inp[mask], series.meas[mask]]))
+    # One collection for all series, colored like consecutive plt.plot calls
+    colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    lines = LineCollection(segments, colors=colors)
+    ax.add_collection(lines)
+    ax.autoscale()
+    return lines
+
+def dump_summary(data):
+    # (clocks, boot cycles, high cycles) per device
+    devices = defaultdict(lambda: ([], [], []))
+    for (device, dtype, clock), series in data.items():
+        clocks, boot, high = devices[device]
+        clocks.append(clock)
+        (boot if clock <= 16e6 else high).append(series.cyc)
+    for device, (clocks, boot, high) in devices.items():
+        minmax_clock = (min(clocks), max(clocks))
+        # One reduction over all cycles of a bucket, 1e9 if the bucket is empty
+        min_cycles_boot = np.concatenate(boot).min() if boot else 1e9
+        min_cycles_high = np.concatenate(high).min() if high else 1e9
         print("| {} | {}/{} | {}ns @ {} MHz | {}ns @ {} MHz |".format(
                 device, min_cycles_boot, min_cycles_high,
                 int(min_cycles_boot * 1e9 / minmax_clock[0]), minmax_clock[0] / 1e6,
                 int(min_cycles_high * 1e9 / minmax_clock[1]), minmax_clock[1] / 1e6))
 
 
+# (text, xy, xytext, kwargs) per figure, plain text labels have no xytext
+ANNOTATIONS = {
+    "ns_boot": [
+        ("STM32L0/L1 @ ~2MHz", (100, 7900), None, {}),
+        ("STM32L0", (7170, 9059), (7000, 9500), {"ha": "right", "va": "bottom"}),
+        ("STM32L1", (9300, 7629), (8200, 6800), {"ha": "left", "va": "bottom"}),
+        ("STM32F7 @ 16MHz", (4020, 4800), (3500, 5200), {"ha": "right", "va": "bottom"}),
+        ("AVR @ 16MHz", (5125, 5640), (4800, 6200), {"ha": "right", "va": "bottom"}),
+        ("STM32F1 @ 8MHz", (2480, 2000), (3000, 1800), {"ha": "left", "va": "top"}),
+        ("STM32L4 @ 16MHz", (910, 812), (1500, 600), {}),
+        ("STM32H7 @ 64MHz", (490, 650), (1000, -100), {}),
+        ("Ideal", (100, 100), (300, -200), {}),
+    ],
+    "ns_high_detail": [
+        ("Ideal", (20, 20), (50, -10), {}),
+        ("STM32L0/L1 @ 32MHz", (10, 545), None, {}),
+        ("STM32F0 @ 48MHz", (10, 412), None, {}),
+        ("STM32L4 @ 48MHz", (10, 330), None, {}),
+        ("STM32L0", (471, 625), (400, 670), {"ha": "right", "va": "center"}),
+        ("STM32G0 @ 64MHz", (611, 655), (560, 790), {"ha": "right", "va": "center"}),
+        ("STM32L1", (619, 531), (660, 460), {"ha": "left", "va": "bottom"}),
+        # ("STM32G4 @ 170MHz", (248, 283), (320, 190), {"ha": "left", "va": "center"}),
+        ("STM32F7 @ 216MHz", (89, 78), (220, 100), {"ha": "left", "va": "center"}),
+        ("STM32H7 @ 400MHz", (46, 60), (120, 40), {"ha": "left", "va": "top"}),
+    ],
+    "ns_high": [
+        ("STM32F7 @ 216MHz", (8000, 7500), (8000, 6000), {"ha": "left", "va": "top"}),
+        ("STM32H7 @ 400MHz", (7000, 5850), (7000, 5000), {"ha": "left", "va": "top"}),
+    ],
+    "us_boot": [
+        ("STM32L0 @ ~2MHz", (200, 210), (200, 300), {"ha": "right", "va": "center"}),
+        ("STM32L1 @ ~2MHz", (400, 403), (390, 490), {"ha": "right", "va": "center"}),
+        ("Ideal", (120, 121), (180, 100), {"ha": "left", "va": "top"}),
+    ],
+}
+
+def annotate(ax, figure):
+    for text, xy, xytext, kwargs in ANNOTATIONS[figure]:
+        if xytext is None:
+            ax.text(*xy, text, fontsize=16, **kwargs)
+        else:
+            ax.annotate(text, xy=xy, xytext=xytext, fontsize=16,
+                        arrowprops={"arrowstyle": "-"}, **kwargs)
+
+def style(ax, unit, ticks=None):
+    if ticks is not None:
+        ax.set_xticks(ticks); ax.set_yticks(ticks)
+    ax.tick_params(labelsize=14)
+    ax.set_xlabel("Input {} delay".format(unit), fontsize=16)
+    ax.set_ylabel("Measured {} delay".format(unit), fontsize=16)
+
+
 if __name__ == "__main__":
-    read_tables("data_*")
+    data = {}
+    read_tables("data_*", data)
+    index = index_tables(data)
 
-    dump_summary()
+    dump_summary(data)
 
+    # One figure for all plots, the axes are cleared between them
     # Large figure
-    plt.figure(figsize=(20, 10))
-    plt.axline((0, 0), (10000, 10000), color="gray")
-    def ns_boot_filter(device, dtype, clock, delay):
-        return (delay[0] <= 10000 and dtype == "ns" and "_error" not in device and
-                (clock <= 16e6 or (device.startswith("h7") and clock <= 64e6)))
-    plot_table(ns_boot_filter)
-    plt.xticks(fontsize=14); plt.yticks(fontsize=14)
-    plt.xlabel("Input nanosecond delay", fontsize=16)
-    plt.ylabel("Measured nanosecond delay", fontsize=16)
-    plt.text(100, 7900, "STM32L0/L1 @ ~2MHz", fontsize=16)
-    plt.annotate("STM32L0", xy = (7170, 9059), fontsize=16, ha='right', va='bottom',
-                 xytext=(7000, 9500), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32L1", xy = (9300, 7629), fontsize=16, ha='left', va='bottom',
-                 xytext=(8200, 6800), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32F7 @ 16MHz", xy = (4020, 4800), fontsize=16, ha='right', va='bottom',
-                 xytext=(3500, 5200), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("AVR @ 16MHz", xy = (5125, 5640), fontsize=16, ha='right', va='bottom',
-                 xytext=(4800, 6200), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32F1 @ 8MHz", xy = (2480, 2000), fontsize=16, ha='left', va='top',
-                 xytext=(3000, 1800), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32L4 @ 16MHz", xy = (910, 812), fontsize=16,
-                 xytext=(1500, 600), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32H7 @ 64MHz", xy = (490, 650), fontsize=16,
-                 xytext=(1000, -100), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("Ideal", xy = (100, 100), fontsize=16,
-                 xytext=(300, -200), arrowprops = {"arrowstyle": "-"})
-    plt.savefig("ns_boot.svg", transparent=True, bbox_inches='tight')
-
-    plt.clf()
-    plt.axline((0, 0), (1000, 1000), color="gray")
-    def ns_high_detail_filter(device, dtype, clock, delay):
-        return (delay[0] <= 1000 and dtype == "ns" and "_error" not in device and
-                ((device.startswith("h7") and clock > 64e6) or
-                 (not device.startswith("h7") and clock > 16e6)))
-    plot_table(ns_high_detail_filter)
-    plt.xticks(range(0, 1001, 100), fontsize=14); plt.yticks(range(0, 1001, 100), fontsize=14)
-    plt.xlabel("Input nanosecond delay", fontsize=16)
-    plt.ylabel("Measured nanosecond delay", fontsize=16)
-    plt.annotate("Ideal", xy = (20, 20), fontsize=16,
-                 xytext=(50, -10), arrowprops = {"arrowstyle": "-"})
-    plt.text(10, 545, "STM32L0/L1 @ 32MHz", fontsize=16)
-    plt.text(10, 412, "STM32F0 @ 48MHz", fontsize=16)
-    plt.text(10, 330, "STM32L4 @ 48MHz", fontsize=16)
-    plt.annotate("STM32L0", xy = (471, 625), fontsize=16, ha='right', va='center',
-                 xytext=(400, 670), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32G0 @ 64MHz", xy = (611, 655), fontsize=16, ha='right', va='center',
-                 xytext=(560, 790), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32L1", xy = (619, 531), fontsize=16, ha='left', va='bottom',
-                 xytext=(660, 460), arrowprops = {"arrowstyle": "-"})
-    # plt.annotate("STM32G4 @ 170MHz", xy = (248, 283), fontsize=16, ha='left', va='center',
-    #              xytext=(320, 190), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32F7 @ 216MHz", xy = (89, 78), fontsize=16, ha='left', va='center',
-                 xytext=(220, 100), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32H7 @ 400MHz", xy = (46, 60), fontsize=16, ha='left', va='top',
-                 xytext=(120, 40), arrowprops = {"arrowstyle": "-"})
-    plt.savefig("ns_high_detail.svg", transparent=True, bbox_inches='tight', pad_inches=0.01)
+    fig, ax = plt.subplots(figsize=(20, 10))
+    ax.axline((0, 0), (10000, 10000), color="gray")
+    plot_table(ax, index, ("ns", "boot"), 10000, exclude="_error")
+    style(ax, "nanosecond")
+    annotate(ax, "ns_boot")
+    fig.savefig("ns_boot.svg", transparent=True, bbox_inches='tight')
+
+    ax.clear()
+    ax.axline((0, 0), (1000, 1000), color="gray")
+    plot_table(ax, index, ("ns", "high"), 1000, exclude="_error")
+    style(ax, "nanosecond", range(0, 1001, 100))
+    annotate(ax, "ns_high_detail")
+    fig.savefig("ns_high_detail.svg", transparent=True, bbox_inches='tight', pad_inches=0.01)
     # plt.show()
 
-    plt.clf()
+    ax.clear()
     # Smaller figure
-    plt.figure(figsize=(20, 8.1))
-    def ns_high_filter(device, dtype, clock, delay):
-        return (delay[0] <= 10000 and dtype == "ns" and "_noerror" not in device and
-                ((device.startswith("h7") and clock > 64e6) or
-                 (not device.startswith("h7") and clock > 16e6)))
-    plot_table(ns_high_filter)
-    plt.xticks(fontsize=14); plt.yticks(fontsize=14);
-    plt.xlabel("Input nanosecond delay", fontsize=16)
-    plt.ylabel("Measured nanosecond delay", fontsize=16)
-    plt.annotate("STM32F7 @ 216MHz", xy = (8000, 7500), fontsize=16, ha='left', va='top',
-                 xytext=(8000, 6000), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32H7 @ 400MHz", xy = (7000, 5850), fontsize=16, ha='left', va='top',
-                 xytext=(7000, 5000), arrowprops = {"arrowstyle": "-"})
-    plt.savefig("ns_high.svg", transparent=True, bbox_inches='tight', pad_inches=0.01)
-
-    # plt.clf()
-    # def ns_high_filter(device, dtype, clock, delay):
-    #     return (delay[0] <= 10000 and dtype == "ns" and "_error" not in device and
-    #             ((device.startswith("h7") and clock > 64e6) or
-    #              (not device.startswith("h7") and clock > 16e6)))
-    # plot_table(ns_high_filter)
-    # plt.xticks(fontsize=14); plt.yticks(fontsize=14);
-    # plt.xlabel("Input nanosecond delay", fontsize=16)
-    # plt.ylabel("Measured nanosecond delay", fontsize=16)
-    # plt.savefig("ns_high_noerror.svg", transparent=True, bbox_inches='tight', pad_inches=0.01)
-
-    plt.clf()
-    def us_boot_filter(device, dtype, clock, delay):
-        return (delay[0] <= 1000 and dtype == "us" and
-                (clock <= 16e6 or (device.startswith("h7") and clock <= 64e6)))
-    plot_table(us_boot_filter)
-    plt.xticks(fontsize=14); plt.yticks(fontsize=14)
-    plt.xlabel("Input microsecond delay", fontsize=16)
-    plt.ylabel("Measured microsecond delay", fontsize=16)
-    plt.annotate("STM32L0 @ ~2MHz", xy = (200, 210), fontsize=16, ha='right', va='center',
-                 xytext=(200, 300), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("STM32L1 @ ~2MHz", xy = (400, 403), fontsize=16, ha='right', va='center',
-                 xytext=(390, 490), arrowprops = {"arrowstyle": "-"})
-    plt.annotate("Ideal", xy = (120, 121), fontsize=16, ha='left', va='top',
-                 xytext=(180, 100), arrowprops = {"arrowstyle": "-"})
-    plt.savefig("us_boot.svg", transparent=True, bbox_inches='tight', pad_inches=0.01)
-
-
-
-
+    fig.set_size_inches(20, 8.1)
+    # Rasterize the dense data lines, axes and annotations stay vector
+    plot_table(ax, index, ("ns", "high"), 10000, exclude="_noerror").set_rasterized(True)
+    style(ax, "nanosecond")
+    annotate(ax, "ns_high")
+    fig.savefig("ns_high.svg", transparent=True, dpi=150, bbox_inches='tight', pad_inches=0.01)
+
+    # ax.clear()
+    # plot_table(ax, index, ("ns", "high"), 10000, exclude="_error")
+    # style(ax, "nanosecond")
+    # fig.savefig("ns_high_noerror.svg", transparent=True, bbox_inches='tight', pad_inches=0.01)
+
+    ax.clear()
+    plot_table(ax, index, ("us", "boot"), 1000).set_rasterized(True)
+    style(ax, "microsecond")
+    annotate(ax, "us_boot")
+    fig.savefig("us_boot.svg", transparent=True, dpi=150, bbox_inches='tight', pad_inches=0.01)